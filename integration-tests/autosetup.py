@@ -6,7 +6,9 @@ from os.path import abspath, basename, exists, dirname, join
 import sys
 import argparse
 import re
+import tarfile
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from pexpect import spawn
@@ -32,12 +34,14 @@ def setup_server(cfg, db):
     interactive with the setup process of the script.
     '''
     info('uncompressing server tarball')
-    shell('tar xf seafile-server_{}_x86-64.tar.gz -C {}'
-          .format(cfg.version, cfg.installdir))
-    if db == 'mysql':
-        autosetup_mysql(cfg)
-    else:
-        autosetup_sqlite3(cfg)
+    # extract in the background, the setup functions wait for it only when
+    # they need the server scripts
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        extracted = executor.submit(_extract_server, cfg)
+        if db == 'mysql':
+            autosetup_mysql(cfg, extracted)
+        else:
+            autosetup_sqlite3(cfg, extracted)
 
     with open(join(cfg.installdir, 'conf/seahub_settings.py'), 'a') as fp:
         fp.write('\n')
@@ -54,8 +58,27 @@ REST_FRAMEWORK = {
         fp.write('\n')
 
 
-def autosetup_sqlite3(cfg):
+def _extract_server(cfg):
+    '''Extract the server tarball into cfg.installdir in a single streaming
+    pass. Every member must live under the seafile-server-<version> dir.
+    '''
+    topdir = 'seafile-server-{}'.format(cfg.version)
+
+    def members(tf):
+        for member in tf:
+            path = os.path.normpath(member.name)
+            if path != topdir and not path.startswith(topdir + os.sep):
+                raise RuntimeError('unexpected path {} in {}'.format(
+                    member.name, cfg.tarball))
+            yield member
+
+    with tarfile.open(cfg.tarball, 'r|gz', bufsize=1 << 17) as tf:
+        tf.extractall(cfg.installdir, members=members(tf))
+
+
+def autosetup_sqlite3(cfg, extracted):
     setup_script = get_script(cfg, 'setup-seafile.sh')
+    extracted.result()
     shell('''sed -i -e '/^check_root;.*/d' "{}"'''.format(setup_script))
 
     if cfg.initmode == 'prompt':
@@ -102,13 +125,17 @@ GRANT ALL PRIVILEGES ON `seahub-existing`.* to `seafile`@localhost;
     shell('mysql -u root -p%s' % MYSQL_ROOT_PASSWD, inputdata=sql)
 
 
-def autosetup_mysql(cfg):
+def autosetup_mysql(cfg, extracted):
     setup_script = get_script(cfg, 'setup-seafile-mysql.sh')
+    if cfg.initmode == 'prompt':
+        # doesn't need the server files
+        createdbs()
+
+    extracted.result()
     if not exists(setup_script):
         print 'please specify seafile script path'
 
     if cfg.initmode == 'prompt':
-        createdbs()
         setup_mysql_prompt(setup_script)
     else :
         # in auto mode, test create new db
@@ -175,11 +202,15 @@ def start_server(cfg):
 
 def _answer_questions(cmd, answers):
     info('expect: spawing %s', cmd)
-    child = spawn(cmd)
+    # Read the output in large chunks and only search the tail of it for
+    # the prompts
+    child = spawn(cmd, maxread=65536, searchwindowsize=4096)
     child.logfile = sys.stdout
 
-    def autofill(pattern, line):
-        child.expect(pattern)
+    # The prompts are matched as plain strings, there's no need for the
+    # regex engine here
+    def autofill(prompt, line):
+        child.expect_exact(prompt)
         child.sendline(line)
 
     for k, v in answers:
@@ -1,13 +1,20 @@
 #!/usr/bin/env python
 
+import errno
 import os
-from os.path import abspath, basename, exists, expanduser, join
+from os.path import abspath, basename, exists, expanduser, getmtime, join
 import sys
-import re
 import glob
+import hashlib
 import json
 import logging
+import multiprocessing
+import shutil
+import threading
 import requests
+from distutils.spawn import find_executable
+from subprocess import check_output
+from concurrent.futures import ThreadPoolExecutor
 
 import termcolor
 from pexpect import spawn
@@ -16,21 +23,35 @@ from autosetup import (setup_server, ServerConfig, get_script, server_dir,
                        start_server, create_test_user, MYSQL_ROOT_PASSWD)
 
 TOPDIR = abspath(join(os.getcwd(), '..'))
+LIBSEARPC_DIR = join(TOPDIR, 'libsearpc')
+CCNET_DIR = join(TOPDIR, 'ccnet')
 PREFIX = expanduser('~/opt/local')
 SRCDIR = '/tmp/src'
 INSTALLDIR = '/tmp/haiwen'
 THIRDPARTDIR = expanduser('~/thirdpart')
+CACHEDIR = expanduser('~/.cache/seafile-it')
 
 logger = logging.getLogger(__file__)
 seafile_version = ''
+_build_env = None
+_build_env_lock = threading.Lock()
 
 TRAVIS_BRANCH = os.environ.get('TRAVIS_BRANCH', 'master')
 
 
 def make_build_env():
+    '''The build env only depends on os.environ, which we never change, so it
+    is computed (and logged) once. Callers must not modify the returned dict.
+    '''
+    global _build_env
+    with _build_env_lock:
+        if _build_env is None:
+            _build_env = _make_build_env()
+        return _build_env
+
+
+def _make_build_env():
     env = dict(os.environ)
-    libsearpc_dir = abspath(join(TOPDIR, 'libsearpc'))
-    ccnet_dir = abspath(join(TOPDIR, 'ccnet'))
 
     def _env_add(*a, **kw):
         kw['env'] = env
@@ -46,11 +67,26 @@ def make_build_env():
     _env_add('PATH', THIRDPARTDIR)
     _env_add('PKG_CONFIG_PATH', os.path.join(PREFIX, 'lib', 'pkgconfig'))
     _env_add('PKG_CONFIG_PATH', os.path.join(PREFIX, 'lib64', 'pkgconfig'))
-    _env_add('PKG_CONFIG_PATH', libsearpc_dir)
-    _env_add('PKG_CONFIG_PATH', ccnet_dir)
+    _env_add('PKG_CONFIG_PATH', LIBSEARPC_DIR)
+    _env_add('PKG_CONFIG_PATH', CCNET_DIR)
+
+    # ccache keeps its default dir ~/.ccache, which is cached by travis
+    if find_executable('ccache'):
+        for key, compiler in (('CC', 'gcc'), ('CXX', 'g++')):
+            value = env.get(key, compiler)
+            if not value.startswith('ccache'):
+                env[key] = 'ccache ' + value
+        env.setdefault('CCACHE_COMPRESS', '1')
+
+    # Keep pip/npm downloads across runs. ~/.cache/pip and CACHEDIR are both
+    # in the travis cache.
+    env.setdefault('PIP_CACHE_DIR', expanduser('~/.cache/pip'))
+    env.setdefault('PIP_DISABLE_PIP_VERSION_CHECK', '1')
+    env.setdefault('PIP_NO_INPUT', '1')
+    env.setdefault('NPM_CONFIG_CACHE', join(CACHEDIR, 'npm'))
 
     for key in ('PATH', 'PKG_CONFIG_PATH', 'CPPFLAGS', 'LDFLAGS',
-                'PYTHONPATH'):
+                'PYTHONPATH', 'CC', 'CXX'):
         info('%s: %s', key, env.get(key, ''))
     return env
 
@@ -76,8 +112,56 @@ def get_project_branch(project, default_branch='master'):
                                            default_branch)
 
 
+class DistCache(object):
+    '''Content addressed store of dist tarballs, so we don't have to run
+    autogen/configure/make dist for projects that haven't changed. Each
+    tarball is stored as <topdir>/<project>/<key>/<tarball name>, where the
+    key is the sha256 of everything the tarball is built from. Only the latest
+    key of each project is kept.
+    '''
+    def __init__(self, topdir):
+        self.topdir = topdir
+
+    def key(self, *inputs):
+        h = hashlib.sha256()
+        for value in inputs:
+            h.update(value)
+            h.update('\0')
+        return h.hexdigest()
+
+    def get(self, project, key):
+        '''Return the path of the cached tarball, or None if there isn't one'''
+        keydir = join(self.topdir, project, key)
+        if not exists(keydir):
+            return None
+        for name in os.listdir(keydir):
+            if name.endswith('.tar.gz') and not name.startswith('.'):
+                return join(keydir, name)
+        return None
+
+    def put(self, project, key, tarball):
+        projectdir = join(self.topdir, project)
+        keydir = join(projectdir, key)
+        _mkdirs(keydir)
+        name = basename(tarball)
+        # copy to a temp file first so an interrupted run never leaves a
+        # truncated tarball that get() would pick up
+        tmp = join(keydir, '.{}.tmp'.format(name))
+        shutil.copy(tarball, tmp)
+        os.rename(tmp, join(keydir, name))
+        # the older tarballs of this project are unlikely to be hit again
+        for old in os.listdir(projectdir):
+            if old != key:
+                shutil.rmtree(join(projectdir, old))
+
+
+dist_cache = DistCache(join(CACHEDIR, 'dist'))
+
+
 class Project(object):
     configure_cmd = './configure'
+    # Whether make_dist could be skipped when the tarball is in dist_cache
+    cache_dist = True
 
     def __init__(self, name):
         self.name = name
@@ -96,43 +180,103 @@ class Project(object):
         return get_project_branch(self)
 
     def clone(self):
-        if exists(self.name):
-            with cd(self.name):
-                shell('git fetch origin --tags')
+        if exists(self.projectdir):
+            shell('git fetch origin --tags', cwd=self.projectdir)
         else:
-            shell('git clone --depth=1 --branch {} {}'.format(self.branch,
-                                                              self.url))
+            # protocol v2 only advertises the refs we ask for, which saves a
+            # round of ref negotiation on repos with lots of tags/branches.
+            shell('git -c protocol.version=2 -c http.version=HTTP/2 '
+                  'clone --depth=1 --single-branch --branch {} {}'
+                  .format(self.branch, self.url),
+                  cwd=TOPDIR)
+
+    def need_autogen(self):
+        '''Whether configure is missing or older than configure.ac'''
+        configure = join(self.projectdir, 'configure')
+        configure_ac = join(self.projectdir, 'configure.ac')
+        return not exists(configure) or (
+            exists(configure_ac) and getmtime(configure_ac) > getmtime(configure))
 
     @chdir
     def make_dist(self):
         info('making tarball for %s', self.name)
-        if exists('./autogen.sh'):
-            shell('./autogen.sh')
-            shell(self.configure_cmd, env=make_build_env())
-        shell('make dist')
+        cmds = []
+        if exists(join(self.projectdir, 'autogen.sh')):
+            need_autogen = self.need_autogen()
+            if need_autogen:
+                cmds.append('./autogen.sh')
+            if need_autogen or not exists(join(self.projectdir, 'config.status')):
+                cmds.append(self.configure_cmd)
+        cmds.append('make -j{} dist'.format(multiprocessing.cpu_count()))
+        # run all the steps in one shell, `set -x` still logs each of them
+        shell('set -ex; ' + '; '.join(cmds), env=make_build_env())
+
+    def dist_inputs(self):
+        '''Everything the dist tarball is built from'''
+        head = check_output(['git', 'rev-parse', 'HEAD'], cwd=self.projectdir,
+                            close_fds=True)
+        return [self.name, head.strip(), self.configure_cmd]
+
+    def dist_cache_key(self):
+        '''Return the key of the dist tarball in dist_cache, or None if the
+        tarball could not be cached, e.g. because the worktree has local
+        changes.
+        '''
+        if not self.cache_dist:
+            return None
+        changes = check_output(['git', 'status', '--porcelain',
+                                '--untracked-files=no'], cwd=self.projectdir,
+                               close_fds=True)
+        if changes.strip():
+            return None
+        return dist_cache.key(*self.dist_inputs())
 
     @chdir
     def copy_dist(self):
-        self.make_dist()
-        tarball = glob.glob('*.tar.gz')[0]
+        key = self.dist_cache_key()
+        tarball = dist_cache.get(self.name, key) if key else None
+        if tarball:
+            info('using cached tarball %s for %s', tarball, self.name)
+        else:
+            self.make_dist()
+            tarball = join(self.projectdir, next(
+                name for name in os.listdir(self.projectdir)
+                if name.endswith('.tar.gz')))
+            if key:
+                dist_cache.put(self.name, key, tarball)
         info('copying %s to %s', tarball, SRCDIR)
-        shell('cp {} {}'.format(tarball, SRCDIR))
-        m = re.match('{}-(.*).tar.gz'.format(self.name), basename(tarball))
-        if m:
-            self.version = m.group(1)
+        _link_or_copy(tarball, join(SRCDIR, basename(tarball)))
+        name = basename(tarball)
+        prefix, suffix = self.name + '-', '.tar.gz'
+        if name.startswith(prefix) and name.endswith(suffix):
+            self.version = name[len(prefix):-len(suffix)]
 
     @chdir
     def use_branch(self, branch):
         shell('git checkout {}'.format(branch))
 
 
+class Libsearpc(Project):
+    # ccnet and seafile are configured against the libsearpc source tree, so
+    # it must always be configured
+    cache_dist = False
+
+    def __init__(self):
+        super(Libsearpc, self).__init__('libsearpc')
+
+
 class Ccnet(Project):
+    # seafile is configured against the ccnet source tree
+    cache_dist = False
+
     def __init__(self):
         super(Ccnet, self).__init__('ccnet')
 
 
 class Seafile(Project):
     configure_cmd = './configure --enable-client --enable-server'
+    # this is the repo under test, its HEAD is new on every CI build
+    cache_dist = False
 
     def __init__(self):
         super(Seafile, self).__init__('seafile')
@@ -148,6 +292,9 @@ class Seahub(Project):
     def __init__(self):
         super(Seahub, self).__init__('seahub')
 
+    def dist_inputs(self):
+        return super(Seahub, self).dist_inputs() + [seafile_version]
+
     @chdir
     def make_dist(self):
         cmds = [
@@ -156,8 +303,9 @@ class Seahub(Project):
             './tools/gen-tarball.py --version={} --branch=HEAD >/dev/null'
             .format(seafile_version),
         ]
+        env = make_build_env()
         for cmd in cmds:
-            shell(cmd, env=make_build_env())
+            shell(cmd, env=env)
 
 
 class SeafDAV(Project):
@@ -195,21 +343,40 @@ def build_server(libsearpc, ccnet, seafile):
 
 
 def fetch_and_build():
-    libsearpc = Project('libsearpc')
+    libsearpc = Libsearpc()
     ccnet = Ccnet()
     seafile = Seafile()
     seahub = Seahub()
     seafobj = SeafObj()
     seafdav = SeafDAV()
 
-    for project in (libsearpc, ccnet, seafile, seahub, seafdav, seafobj):
-        if project.name != 'seafile':
-            project.clone()
-        project.copy_dist()
+    projects = (libsearpc, ccnet, seafile, seahub, seafdav, seafobj)
+    with ThreadPoolExecutor(max_workers=len(projects)) as executor:
+        clones = [executor.submit(project.clone)
+                  for project in projects if project.name != 'seafile']
+        _wait_all(clones)
+
+        # ccnet and seafile are configured against the libsearpc/ccnet source
+        # trees, and seahub needs seafile_version, so these four are built in
+        # order. seafdav and seafobj don't depend on anything.
+        def build_chain():
+            for project in (libsearpc, ccnet, seafile, seahub):
+                project.copy_dist()
+
+        dists = [executor.submit(build_chain)]
+        dists += [executor.submit(project.copy_dist)
+                  for project in (seafdav, seafobj)]
+        _wait_all(dists)
 
     build_server(libsearpc, ccnet, seafile)
 
 
+def _wait_all(futures):
+    '''Wait for all the futures, re-raising the first error if any'''
+    for future in futures:
+        future.result()
+
+
 def run_tests(cfg):
     # run_python_seafile_tests()
     # run_seafdav_tests(cfg)
@@ -224,7 +391,7 @@ def run_python_seafile_tests():
     if not exists(python_seafile.projectdir):
         python_seafile.clone()
         shell('pip install -r {}/requirements.txt'.format(
-            python_seafile.projectdir))
+            python_seafile.projectdir), env=make_build_env())
 
     with cd(python_seafile.projectdir):
         # install python-seafile because seafdav tests needs it
@@ -245,15 +412,33 @@ def _seafdav_env(cfg):
 
 def run_seafdav_tests(cfg):
     seafdav = SeafDAV()
-    shell('pip install -r {}/test-requirements.txt'.format(seafdav.projectdir))
+    shell('pip install -r {}/test-requirements.txt'.format(seafdav.projectdir),
+          env=make_build_env())
     with cd(seafdav.projectdir):
         shell('nosetests -v -s', env=_seafdav_env(cfg))
 
 
+def _link_or_copy(src, dst):
+    '''Hard link src to dst, or copy it if they're on different filesystems.
+    An existing dst is removed first instead of being overwritten, since it
+    may be a link to a tarball in dist_cache.
+    '''
+    if exists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
 def _mkdirs(*paths):
+    '''Like `mkdir -p`, also safe to call from several threads at once'''
     for path in paths:
-        if not exists(path):
-            os.mkdir(path)
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
 
 
 def main():
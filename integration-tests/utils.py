@@ -5,6 +5,7 @@ from os.path import abspath, basename, exists, expanduser, join
 import sys
 import re
 import logging
+import threading
 from contextlib import contextmanager
 from subprocess import Popen, PIPE, CalledProcessError
 
@@ -14,9 +15,17 @@ from pexpect import spawn
 
 logger = logging.getLogger(__file__)
 
+# Per-thread default working directory for shell(), set by the chdir
+# decorator. We can't use os.chdir there because projects are built in
+# parallel threads and the process cwd is shared between them.
+_local = threading.local()
+_main_thread = threading.current_thread()
+
+# stdout won't change from/to a tty while we run
+_IS_TTY = sys.stdout.isatty()
+
 def _color(s, color):
-    return s if not os.isatty(sys.stdout.fileno()) \
-        else termcolor.colored(str(s), color)
+    return termcolor.colored(str(s), color) if _IS_TTY else s
 
 
 def green(s):
@@ -27,22 +36,36 @@ def red(s):
     return _color(s, 'red')
 
 
-def debug(fmt, *a):
-    logger.debug(green(fmt), *a)
-
+debug = logger.debug
+info = logger.info
+warning = logger.warning
 
-def info(fmt, *a):
-    logger.info(green(fmt), *a)
 
+class LevelColorFormatter(logging.Formatter):
+    '''Color the log lines by level when stdout is a tty. Done here rather than
+    in debug/info/warning so that filtered records cost nothing.
+    '''
+    colors = {
+        'DEBUG': 'green',
+        'INFO': 'green',
+        'WARNING': 'red',
+    }
 
-def warning(fmt, *a):
-    logger.warn(red(fmt), *a)
+    def format(self, record):
+        s = logging.Formatter.format(self, record)
+        color = self.colors.get(record.levelname, 'red')
+        return termcolor.colored(s, color) if _IS_TTY else s
 
 
 def shell(cmd, inputdata=None, **kw):
-    info('calling "%s" in %s', cmd, kw.get('cwd', os.getcwd()))
+    kw.setdefault('cwd', getattr(_local, 'cwd', None))
+    info('calling "%s" in %s', cmd, kw['cwd'] or os.getcwd())
     kw['shell'] = not isinstance(cmd, list)
     kw['stdin'] = PIPE if inputdata else None
+    # python2 pipes are inheritable, so a child started from a build thread
+    # could keep another thread's check_output() pipe open until it exits.
+    # The main thread runs one command at a time and skips the fd sweep.
+    kw.setdefault('close_fds', threading.current_thread() is not _main_thread)
     p = Popen(cmd, **kw)
     if inputdata:
         p.communicate(inputdata)
@@ -62,20 +85,27 @@ def cd(path):
 
 
 def chdir(func):
+    '''Run shell() commands of the decorated method in self.projectdir. Unlike
+    cd(), this is thread-safe: the method itself must use absolute paths.
+    '''
     def wrapped(self, *w, **kw):
-        with cd(self.projectdir):
+        olddir = getattr(_local, 'cwd', None)
+        _local.cwd = self.projectdir
+        try:
             return func(self, *w, **kw)
+        finally:
+            _local.cwd = olddir
 
     return wrapped
 
 def setup_logging():
-    kw = {
-        'format': '[%(asctime)s][%(module)s]: %(message)s',
-        'datefmt': '%m/%d/%Y %H:%M:%S',
-        'level': logging.DEBUG,
-        'stream': sys.stdout,
-    }
-
-    logging.basicConfig(**kw)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(LevelColorFormatter(
+        fmt='[%(asctime)s][%(module)s]: %(message)s',
+        datefmt='%m/%d/%Y %H:%M:%S'))
+
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG)
     logging.getLogger('requests.packages.urllib3.connectionpool').setLevel(
         logging.WARNING)